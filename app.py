@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 import logging
 import asyncio
-from flask import Flask, request, abort
+from aiohttp import web
 from dotenv import load_dotenv
 import os
 
-# Импорт Aiogram для обработки Update
-from aiogram import types 
+# Встроенная интеграция Aiogram с aiohttp
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # Загружаем переменные окружения из .env
 load_dotenv()
@@ -24,7 +24,7 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 API_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 # TARGET_CHAT_ID считывается как строка, преобразуем в int
-TARGET_CHAT_ID = int(os.getenv("TARGET_CHAT_ID", 0)) 
+TARGET_CHAT_ID = int(os.getenv("TARGET_CHAT_ID", 0))
 
 if not API_TOKEN or not WEBHOOK_URL:
     logging.error("BOT_TOKEN или WEBHOOK_URL не установлены.")
@@ -34,82 +34,92 @@ if not API_TOKEN or not WEBHOOK_URL:
 bot.API_TOKEN = API_TOKEN
 bot.WEBHOOK_URL = WEBHOOK_URL
 bot.TARGET_CHAT_ID = TARGET_CHAT_ID
+# ELO_PAIRWISE=1 включает попарный расчет Elo для парных матчей
+bot.ELO_PAIRWISE = os.getenv("ELO_PAIRWISE", "0") == "1"
 
-# Создаем Flask-приложение
-app = Flask(__name__)
-
-# Флаг для контроля, был ли Webhook установлен (для Gunicorn/Flask)
-app_is_ready = False
-
-# --- Функции запуска (Synchronous Wrapper) ---
-
-def run_async_setup():
-    """Синхронная обертка для асинхронной настройки бота."""
-    global app_is_ready
-    if app_is_ready:
-        return
-        
-    logging.info("Запуск асинхронной настройки (БД, Планировщик, Webhook)...")
-    try:
-        # Создаем новый цикл событий для Gunicorn worker
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # 1. Запускаем асинхронную функцию настройки (инициализация БД и планировщика)
-        loop.run_until_complete(bot.start_webhook()) 
-        
-        # 2. Устанавливаем Webhook через API Telegram
-        # Важно: URL должен быть полным (https://165.227.164.121/webhook)
-        loop.run_until_complete(bot.bot.set_webhook(url=WEBHOOK_URL))
-        
-        logging.info(f"Webhook успешно установлен: {WEBHOOK_URL}")
-        app_is_ready = True
-    except Exception as e:
-        logging.error(f"КРИТИЧЕСКАЯ ОШИБКА во время настройки бота: {e}")
-        # Если setup не удался, worker должен завершиться
-        raise
-
-# Запускаем настройку при импорте (т.е. при запуске каждого Gunicorn worker)
-run_async_setup() 
-
-
-# --- Webhook Endpoint ---
-
-@app.route('/webhook', methods=['POST'])
-async def telegram_webhook():
-    """Обработка входящих обновлений от Telegram."""
-    if not app_is_ready:
-        # Если worker не готов, отклоняем запрос
-        return "Worker not initialized", 503 
-        
-    if request.method == 'POST':
-        # Получаем JSON-данные
-        update_json = request.get_json(silent=True)
-        if update_json:
-            try:
-                # Преобразуем JSON в объект Update Aiogram
-                update = types.Update.model_validate(update_json)
-                
-                # Передаем обновление диспетчеру для обработки
-                await bot.dp.feed_update(bot.bot, update)
-                
-                return "OK", 200
-            except Exception as e:
-                logging.error(f"Ошибка обработки обновления: {e}")
-                return "Internal Server Error", 500
-        
-        return "Not JSON", 400
-    
-    return abort(405) # Метод не разрешен
-
-
-@app.route('/', methods=['GET'])
-def index():
-    """Простой health check для проверки, что сервер работает."""
-    return "Tennis Ladder Bot is running.", 200
+
+# Состояние worker: init -> ready, либо failed (настройка будет повторена)
+STATE_INIT = "init"
+STATE_READY = "ready"
+STATE_FAILED = "failed"
+app_state = STATE_INIT
+
+# Пауза между повторными попытками настройки (секунды)
+BOOT_RETRY_DELAY = 10
+
+# Ключ приложения для фоновой задачи настройки
+BOOT_TASK = web.AppKey("boot_task", asyncio.Task)
+
+
+# --- Функции запуска ---
+
+async def boot():
+    """Асинхронная настройка бота; повторяется, пока не завершится успешно."""
+    global app_state
+    while True:
+        logging.info("Запуск асинхронной настройки (БД, Webhook)...")
+        try:
+            # 1. Инициализация БД и таймеров заявок
+            await bot.start_webhook()
+
+            # 2. Устанавливаем Webhook через API Telegram
+            # Важно: URL должен быть полным (https://165.227.164.121/webhook)
+            await bot.bot.set_webhook(url=WEBHOOK_URL)
+
+            logging.info(f"Webhook успешно установлен: {WEBHOOK_URL}")
+            app_state = STATE_READY
+            return
+        except Exception as e:
+            logging.error(f"КРИТИЧЕСКАЯ ОШИБКА во время настройки бота: {e}")
+            app_state = STATE_FAILED
+            await asyncio.sleep(BOOT_RETRY_DELAY)
+
+
+async def on_startup(app: web.Application):
+    """Запускает настройку в фоне, не задерживая старт worker."""
+    app[BOOT_TASK] = asyncio.create_task(boot())
+
+
+async def on_cleanup(app: web.Application):
+    """Останавливает незавершенную настройку."""
+    app[BOOT_TASK].cancel()
+
+
+@web.middleware
+async def readiness_middleware(request: web.Request, handler):
+    """Отклоняет обновления, пока worker не готов (Telegram повторит доставку)."""
+    if request.path == '/webhook' and app_state != STATE_READY:
+        return web.Response(status=503, text="Worker not initialized")
+    return await handler(request)
+
+
+# --- Health check ---
+
+async def index(request: web.Request) -> web.Response:
+    """Health check: 200 только когда worker готов, иначе 503 (балансировщик выведет его из ротации)."""
+    if app_state != STATE_READY:
+        return web.Response(status=503, text=f"Tennis Ladder Bot is not ready ({app_state}).")
+    return web.Response(text="Tennis Ladder Bot is running.")
+
+
+def create_app() -> web.Application:
+    """Создает aiohttp-приложение: обновления обрабатываются в том же цикле, где живет сессия бота."""
+    app = web.Application(middlewares=[readiness_middleware])
+
+    # Webhook Endpoint: разбор Update и передача диспетчеру
+    SimpleRequestHandler(dispatcher=bot.dp, bot=bot.bot).register(app, path='/webhook')
+    app.router.add_get('/', index)
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    setup_application(app, bot.dp, bot=bot.bot)
+    return app
+
+
+# Точка входа для Gunicorn: gunicorn app:app --worker-class aiohttp.GunicornWebWorker
+app = create_app()
 
 
 if __name__ == '__main__':
-    # Эта часть не используется Gunicorn
-    logging.warning("Запуск Flask локально. Используйте Gunicorn/Systemd для production.")
-    app.run(host='0.0.0.0', port=8000)
+    logging.info("Запуск aiohttp-сервера на 0.0.0.0:8000.")
+    web.run_app(app, host='0.0.0.0', port=8000)
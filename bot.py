@@ -1,20 +1,25 @@
 # -*- coding: utf-8 -*-
 import logging
+import asyncio
+import os
 import time
 import math
+import functools
 import re
 from typing import List, Tuple, Optional, Dict
 
+import numpy as np
+import orjson
+
 # Aiogram imports
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-# APScheduler imports
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.jobstores.memory import MemoryJobStore
-
 # Database import
 from bot_db import Database
 
@@ -22,27 +27,74 @@ from bot_db import Database
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Глобальные переменные (будут заполнены из app.py) ---
-API_TOKEN = ""
+# Токен нужен уже при создании Bot ниже, поэтому читаем его из окружения (app.py загружает .env до импорта)
+API_TOKEN = os.getenv("BOT_TOKEN", "")
 WEBHOOK_URL = ""
 TARGET_CHAT_ID = 0 
 
-# Инициализация базы данных и планировщика
+# Инициализация базы данных
 DB_NAME = 'bot.db'
 db = Database(DB_NAME)
-scheduler = AsyncIOScheduler(jobstores={'default': MemoryJobStore()})
 
-# Инициализация бота и диспетчера (parse_mode установлен в диспетчере)
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(storage=MemoryStorage(), parse_mode=ParseMode.HTML)
+# Тайм-аут заявки на матч (2 часа) и активные таймеры отмены: pending_id -> Task
+PENDING_MATCH_TTL = 2 * 3600
+_pending_timers: Dict[int, asyncio.Task] = {}
+
+class TelegramSession(AiohttpSession):
+    """Сессия aiohttp с пулом keep-alive соединений к api.telegram.org.
+
+    JSON (ответы API и входящие webhook-обновления) разбирается через orjson.
+    """
+    def __init__(self, **kwargs):
+        # limit оставляем стандартным для aiogram (100), ttl_dns_cache=3600 тоже задает сам aiogram
+        super().__init__(json_loads=orjson.loads, **kwargs)
+        # TCPConnector создается лениво в create_session() из этих параметров.
+        # Соединение держится 75 секунд вместо 15 по умолчанию в aiohttp: между ответами Telegram
+        # пул не закрывает keep-alive соединения и не повторяет TLS-рукопожатие
+        self._connector_init.update(keepalive_timeout=75)
+
+# Инициализация бота и диспетчера (parse_mode по умолчанию задается боту)
+bot = Bot(
+    token=API_TOKEN,
+    session=TelegramSession(),
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
+dp = Dispatcher(storage=MemoryStorage())
+
+# Кэш участников чата: user_id -> (username, full_name, expires_at)
+MEMBER_CACHE_TTL = 3600
+_member_cache: Dict[int, Tuple[str, str, float]] = {}
+
+# Разбор аргументов /new_result: каждый токен целиком — @тег игрока или счет вида 11-9
+# (шаблоны применяются через fullmatch, поэтому "11-9-3", "me@alice.com" или @al не подходят)
+_TAG_RE = re.compile(r'@([A-Za-z0-9_]{3,32})')
+_SCORE_RE = re.compile(r'\d{1,2}-\d{1,2}')
 
 # --- Настройка Elo ---
 DEFAULT_RATING = 1000
+# Попарный Elo (каждый победитель против каждого проигравшего) вместо среднего по команде
+ELO_PAIRWISE = False
 
 def calculate_k_factor(r1: int, r2: int) -> float:
-    """Вычисляет K-фактор по формуле: K = 15 + |R1 - R2| / 100"""
+    """Вычисляет K-фактор по формуле: K = 15 + |R1 - R2| / 100 (принимает и массивы NumPy)"""
     diff = abs(r1 - r2)
     return 15.0 + diff / 100.0
 
+# ln(10) / 400: 10 ** (x / 400) == exp(x * _LN10_400)
+_LN10_400 = math.log(10.0) / 400.0
+
+def _expected_score(diff, exp=math.exp):
+    """Ожидаемый результат (Ea) при разнице рейтингов diff = R_winner - R_loser.
+
+    Для массива разностей передается exp=np.exp.
+    """
+    return 1.0 / (1.0 + exp(-diff * _LN10_400))
+
+@functools.lru_cache(maxsize=4096)
+def _expected(diff: int) -> float:
+    """Ожидаемый результат (Ea) для одной пары; значения кэшируются."""
+    return _expected_score(diff)
+
 def calculate_elo_change(rating_winner: int, rating_loser: int) -> int:
     """
     Рассчитывает изменение рейтинга Elo.
@@ -51,7 +103,7 @@ def calculate_elo_change(rating_winner: int, rating_loser: int) -> int:
     :return: Изменение рейтинга (delta R).
     """
     # Ожидаемый результат для победителя (Ea)
-    expected_score_winner = 1.0 / (1.0 + 10.0 ** ((rating_loser - rating_winner) / 400.0))
+    expected_score_winner = _expected(rating_winner - rating_loser)
     
     k = calculate_k_factor(rating_winner, rating_loser)
     
@@ -60,63 +112,142 @@ def calculate_elo_change(rating_winner: int, rating_loser: int) -> int:
     
     return int(round(delta_r))
 
+def _split_team_delta(total: int, shares: np.ndarray) -> List[int]:
+    """Делит целое изменение команды между игроками пропорционально shares (сумма сохраняется)."""
+    exact = total * shares / shares.sum()
+    parts = np.floor(exact).astype(np.int64)
+    # Недостающие единицы получают игроки с наибольшей дробной частью
+    remainder = total - int(parts.sum())
+    parts[np.argsort(parts - exact)[:remainder]] += 1
+    return parts.tolist()
+
+def elo_deltas_pairwise(winner_ratings: List[int], loser_ratings: List[int]) -> Tuple[List[int], List[int]]:
+    """
+    Попарный расчет Elo: каждый победитель сыграл с каждым проигравшим.
+    :param winner_ratings: Рейтинги победителей.
+    :param loser_ratings: Рейтинги проигравших.
+    :return: Изменения рейтинга победителей и проигравших (delta R).
+    """
+    w = np.asarray(winner_ratings, dtype=np.float64)
+    l = np.asarray(loser_ratings, dtype=np.float64)
+
+    # Матрица выигрышей: строки — проигравшие, столбцы — победители (те же формулы, что и в calculate_elo_change)
+    diff = w[None, :] - l[:, None]
+    gain = calculate_k_factor(w[None, :], l[:, None]) * (1.0 - _expected_score(diff, np.exp))
+
+    # Округляем изменение команды целиком: победители получают ровно столько, сколько теряют проигравшие
+    total = int(round(gain.sum()))
+    winner_deltas = _split_team_delta(total, gain.sum(axis=0))
+    loser_deltas = [-d for d in _split_team_delta(total, gain.sum(axis=1))]
+    return winner_deltas, loser_deltas
+
 # --- Хелперы ---
 
-def format_match_description(winner_ids: List[int], loser_ids: List[int], score: str, match_type: str) -> str:
-    """Форматирует описание матча для сообщения подтверждения."""
-    if match_type == '1vs1':
-        winner_tag = f"@{bot.get_my_username()}" # Заглушка, позже будет реальный username
-        loser_tag = f"@{bot.get_my_username()}" # Заглушка
-        return (
-            f"🎾 <b>Одиночный матч (1v1)</b>\n"
-            f"🥇 Победитель: @winner_tag\n"
-            f"🥈 Проигравший: @loser_tag\n"
-            f"📊 Счет: {score}"
-        )
-    elif match_type == '2vs2':
-        winners_tags = [f"@{bot.get_my_username()}"] * len(winner_ids) # Заглушка
-        losers_tags = [f"@{bot.get_my_username()}"] * len(loser_ids) # Заглушка
-        return (
-            f"🏓 <b>Парный матч (2v2)</b>\n"
-            f"🥇 Победители: {', '.join(winners_tags)}\n"
-            f"🥈 Проигравшие: {', '.join(losers_tags)}\n"
-            f"📊 Счет: {score}"
-        )
-    return "Неизвестный тип матча."
+def _cache_member(user_id: int, username: str, full_name: str):
+    """Сохраняет данные участника в кэше на MEMBER_CACHE_TTL секунд."""
+    _member_cache[user_id] = (username, full_name, time.monotonic() + MEMBER_CACHE_TTL)
+
+def _parse_result_args(text: str) -> Optional[Tuple[List[str], str]]:
+    """Разбирает аргументы /new_result на теги и счет.
+
+    :return: (теги без '@', счет) или None, если есть лишние токены или счет указан не ровно один раз.
+    """
+    tags: List[str] = []
+    scores: List[str] = []
+    for token in text.split():
+        tag_match = _TAG_RE.fullmatch(token)
+        if tag_match:
+            tags.append(tag_match.group(1))
+        elif _SCORE_RE.fullmatch(token):
+            scores.append(token)
+        else:
+            return None
+    if not tags or len(scores) != 1:
+        return None
+    return tags, scores[0]
+
+def _format_player_name(user_id: int, username: Optional[str], full_name: Optional[str]) -> str:
+    """Возвращает @username или полное имя (если username нет)."""
+    # В БД вместо отсутствующего username хранится строковый ID
+    if username and username != str(user_id):
+        return f"@{username}"
+    if full_name:
+        return f"<b>{full_name}</b>"
+    return f"Неизвестный игрок ({user_id})"
+
+def _format_team_deltas(names: List[str], deltas: List[int]) -> str:
+    """Форматирует имена команды с изменением рейтинга (общим или у каждого игрока)."""
+    if len(set(deltas)) == 1:
+        return f"{', '.join(names)} (<b>{deltas[0]:+d}</b>)"
+    return ", ".join(f"{name} (<b>{delta:+d}</b>)" for name, delta in zip(names, deltas))
+
+async def _resolve_one(user_id: int) -> str:
+    """Получает имя участника из Telegram API и сохраняет его в БД и кэше."""
+    member = await bot.get_chat_member(TARGET_CHAT_ID, user_id)
+    username = member.user.username if member.user.username else str(user_id)
+    full_name = member.user.full_name
+
+    await asyncio.to_thread(db.get_or_create_player, user_id, username, full_name)
+    _cache_member(user_id, username, full_name)
+    return _format_player_name(user_id, username, full_name)
 
 async def resolve_usernames(user_ids: List[int]) -> List[str]:
-    """Преобразует список ID в список @usernames или полных имен."""
-    resolved_names = []
-    for user_id in user_ids:
-        try:
-            # Получаем информацию о пользователе из Telegram
-            member = await bot.get_chat_member(TARGET_CHAT_ID, user_id)
-            username = member.user.username
-            full_name = member.user.full_name
-            
-            if username:
-                resolved_names.append(f"@{username}")
-            else:
-                resolved_names.append(f"<b>{full_name}</b>")
-        except Exception:
-            resolved_names.append(f"Неизвестный игрок ({user_id})")
-    return resolved_names
-
-async def update_player_info(user_id: int):
-    """Обновляет или создает запись игрока в БД."""
+    """Преобразует список ID в список @usernames или полных имен.
+
+    Сначала проверяется кэш, затем БД (одним запросом на все промахи),
+    и только оставшиеся ID параллельно запрашиваются у Telegram API.
+    """
+    resolved: Dict[int, str] = {}
+    misses = []
+    now = time.monotonic()
+    for user_id in dict.fromkeys(user_ids):
+        cached = _member_cache.get(user_id)
+        if cached and cached[2] > now:
+            resolved[user_id] = _format_player_name(user_id, cached[0], cached[1])
+        else:
+            misses.append(user_id)
+
+    if misses:
+        players = await asyncio.to_thread(db.get_players_by_ids, misses)
+        for user_id, (username, full_name) in players.items():
+            _cache_member(user_id, username, full_name)
+            resolved[user_id] = _format_player_name(user_id, username, full_name)
+
+        unknown = [user_id for user_id in misses if user_id not in resolved]
+        results = await asyncio.gather(*[_resolve_one(uid) for uid in unknown], return_exceptions=True)
+        for user_id, result in zip(unknown, results):
+            resolved[user_id] = f"Неизвестный игрок ({user_id})" if isinstance(result, Exception) else result
+
+    return [resolved[user_id] for user_id in user_ids]
+
+async def update_player_info(user: types.User):
+    """Обновляет или создает запись игрока в БД (и в кэше участников).
+
+    Данные берутся из самого обновления (from_user), без запроса к Telegram API.
+    """
+    username = user.username if user.username else str(user.id)
     try:
-        member = await bot.get_chat_member(TARGET_CHAT_ID, user_id)
-        username = member.user.username if member.user.username else str(user_id)
-        full_name = member.user.full_name
-        db.get_or_create_player(user_id, username, full_name)
+        await asyncio.to_thread(db.get_or_create_player, user.id, username, user.full_name)
+        _cache_member(user.id, username, user.full_name)
     except Exception as e:
-        logging.error(f"Не удалось получить или создать игрока {user_id}: {e}")
+        logging.error(f"Не удалось получить или создать игрока {user.id}: {e}")
 
 # --- Обработчик команд ---
 
-@dp.message(F.text.startswith('/new_result'))
-async def handle_new_result_command(message: types.Message):
-    """Обрабатывает команды /new_result_1vs1 и /new_result_2vs2."""
+@dp.message(Command('new_result_1vs1'))
+async def handle_new_result_1vs1(message: types.Message, command: CommandObject):
+    """Обрабатывает команду /new_result_1vs1."""
+    await handle_new_result_command(message, command.args, '1vs1')
+
+
+@dp.message(Command('new_result_2vs2'))
+async def handle_new_result_2vs2(message: types.Message, command: CommandObject):
+    """Обрабатывает команду /new_result_2vs2."""
+    await handle_new_result_command(message, command.args, '2vs2')
+
+
+async def handle_new_result_command(message: types.Message, args: Optional[str], match_type: str):
+    """Общая логика команд /new_result_1vs1 и /new_result_2vs2."""
     if message.chat.type not in ['group', 'supergroup']:
         await message.reply("Этот бот работает только в групповых чатах.")
         return
@@ -127,8 +258,8 @@ async def handle_new_result_command(message: types.Message):
         TARGET_CHAT_ID = message.chat.id
         logging.info(f"Установлен TARGET_CHAT_ID: {TARGET_CHAT_ID}")
 
-    parts = message.text.split()
-    if len(parts) < 4:
+    parsed = _parse_result_args(args or "")
+    if parsed is None:
         await message.reply(
             "Неверный формат команды. Используйте:\n"
             "<code>/new_result_1vs1 @победитель @проигравший 11-9</code>\n"
@@ -137,11 +268,7 @@ async def handle_new_result_command(message: types.Message):
         )
         return
 
-    command = parts[0]
-    score = parts[-1]
-    tags = [t.lstrip('@') for t in parts[1:-1]]
-    
-    match_type = '1vs1' if command.endswith('1vs1') else '2vs2'
+    tags, score = parsed
 
     if match_type == '1vs1' and len(tags) != 2:
         await message.reply("Для 1v1 нужно 2 игрока: @победитель @проигравший.")
@@ -155,15 +282,12 @@ async def handle_new_result_command(message: types.Message):
     # В 1vs1: tags[0]=winner, tags[1]=loser
     # В 2vs2: tags[0], tags[1]=winners, tags[2], tags[3]=losers
     
-    all_tags = set(tags)
-    user_ids: Dict[str, int] = {}
-    
-    for tag in all_tags:
-        user_id = db.get_user_id_by_tag(tag)
-        if user_id is None:
-            await message.reply(f"Не найден пользователь с @{tag}. Попросите его отправить любое сообщение в чат.")
-            return
-        user_ids[tag] = user_id
+    user_ids: Dict[str, int] = await asyncio.to_thread(db.get_user_ids_by_tags, list(set(tags)))
+
+    missing_tags = [tag for tag in tags if tag not in user_ids]
+    if missing_tags:
+        await message.reply(f"Не найден пользователь с @{missing_tags[0]}. Попросите его отправить любое сообщение в чат.")
+        return
 
     # 2. Распределяем ID по командам
     if match_type == '1vs1':
@@ -183,27 +307,26 @@ async def handle_new_result_command(message: types.Message):
         return
 
     # 3. Сохраняем заявку в pending
-    pending_id = db.add_pending_match(
+    pending_id = await asyncio.to_thread(
+        db.add_pending_match,
         match_type, 
-        participants_ids, 
         winner_ids, 
         loser_ids, 
         score
     )
 
     # 4. Запускаем таймер на отмену (2 часа)
-    scheduler.add_job(
-        delete_pending_match_job, 
-        'date', 
-        run_date=time.time() + 2 * 3600, # 2 часа в секундах
-        args=[pending_id, message.chat.id, message.message_id]
+    _pending_timers[pending_id] = asyncio.create_task(
+        _cancel_after(pending_id, message.chat.id, message.message_id, PENDING_MATCH_TTL)
     )
 
     # 5. Генерируем сообщение для подтверждения
     
     # Разрешаем имена для отображения
-    winner_names = await resolve_usernames(winner_ids)
-    loser_names = await resolve_usernames(loser_ids)
+    winner_names, loser_names = await asyncio.gather(
+        resolve_usernames(winner_ids),
+        resolve_usernames(loser_ids)
+    )
     
     description = (
         f"🎾 <b>Матч ({match_type})</b>\n"
@@ -231,18 +354,14 @@ async def process_match_confirmation(callback: types.CallbackQuery):
     match_id = int(callback.data.split('_')[1])
     user_id = callback.from_user.id
 
-    pending_match_data = db.get_pending_match(match_id)
+    pending_match_data = await asyncio.to_thread(db.get_pending_match, match_id)
     
     if not pending_match_data:
         await callback.answer("Эта заявка уже обработана или отменена.")
         await callback.message.delete_reply_markup()
         return
 
-    match_type, winner_ids_str, loser_ids_str, score = pending_match_data
-    
-    # Преобразуем строки ID в списки int
-    winner_ids = [int(i) for i in winner_ids_str.split(',')]
-    loser_ids = [int(i) for i in loser_ids_str.split(',')]
+    match_type, winner_ids, loser_ids, score = pending_match_data
     
     participants = winner_ids + loser_ids
 
@@ -253,38 +372,53 @@ async def process_match_confirmation(callback: types.CallbackQuery):
 
     # --- Подтверждение принято, пересчет Elo ---
 
-    # 1. Получаем текущие рейтинги
-    winner_ratings = [db.get_player_rating(uid) for uid in winner_ids]
-    loser_ratings = [db.get_player_rating(uid) for uid in loser_ids]
-    
-    # Средний рейтинг команд
-    avg_winner_rating = sum(winner_ratings) / len(winner_ratings)
-    avg_loser_rating = sum(loser_ratings) / len(loser_ratings)
+    # 1. Получаем текущие рейтинги (одним запросом)
+    ratings = await asyncio.to_thread(db.get_player_ratings, participants)
+    winner_ratings = [ratings[uid] for uid in winner_ids]
+    loser_ratings = [ratings[uid] for uid in loser_ids]
     
     # 2. Рассчитываем изменение рейтинга
-    delta_r = calculate_elo_change(int(avg_winner_rating), int(avg_loser_rating))
-    
-    # 3. Применяем изменения
+    if ELO_PAIRWISE:
+        winner_deltas, loser_deltas = elo_deltas_pairwise(winner_ratings, loser_ratings)
+    else:
+        # Средний рейтинг команд
+        avg_winner_rating = sum(winner_ratings) / len(winner_ratings)
+        avg_loser_rating = sum(loser_ratings) / len(loser_ratings)
+
+        # Победители получают delta_r, проигравшие теряют delta_r
+        delta_r = calculate_elo_change(int(avg_winner_rating), int(avg_loser_rating))
+        winner_deltas = [delta_r] * len(winner_ids)
+        loser_deltas = [-delta_r] * len(loser_ids)
     
-    # Победители: получают delta_r
-    for uid in winner_ids:
-        db.update_player_rating(uid, delta_r)
-        
-    # Проигравшие: теряют delta_r
-    for uid in loser_ids:
-        db.update_player_rating(uid, -delta_r)
+    # 3. Применяем изменения, финализация и очистка (одной транзакцией)
+    history_id = await asyncio.to_thread(
+        db.finalize_match,
+        match_id,
+        [(uid, delta, True) for uid, delta in zip(winner_ids, winner_deltas)]
+        + [(uid, delta, False) for uid, delta in zip(loser_ids, loser_deltas)]
+    )
+
+    if history_id is None:
+        # Заявку успел подтвердить другой участник
+        await callback.answer("Эта заявка уже обработана или отменена.")
+        await callback.message.delete_reply_markup()
+        return
 
-    # 4. Финализация и очистка
-    db.finalize_match(match_id, winner_ids, loser_ids, score, match_type)
+    # Таймер отмены больше не нужен
+    timer = _pending_timers.pop(match_id, None)
+    if timer:
+        timer.cancel()
     
-    # 5. Оповещение
-    winner_names = await resolve_usernames(winner_ids)
-    loser_names = await resolve_usernames(loser_ids)
+    # 4. Оповещение
+    winner_names, loser_names = await asyncio.gather(
+        resolve_usernames(winner_ids),
+        resolve_usernames(loser_ids)
+    )
     
     notification = (
-        f"✅ <b>МАТЧ ПОДТВЕРЖДЕН!</b> (ID: {match_id})\n"
-        f"🥇 Победители: {', '.join(winner_names)} (<b>+{delta_r}</b>)\n"
-        f"🥈 Проигравшие: {', '.join(loser_names)} (<b>{-delta_r}</b>)\n"
+        f"✅ <b>МАТЧ ПОДТВЕРЖДЕН!</b> (ID: {history_id})\n"
+        f"🥇 Победители: {_format_team_deltas(winner_names, winner_deltas)}\n"
+        f"🥈 Проигравшие: {_format_team_deltas(loser_names, loser_deltas)}\n"
         f"📊 Счет: {score}\n"
     )
 
@@ -297,7 +431,7 @@ async def process_match_confirmation(callback: types.CallbackQuery):
 
 # --- Команда /start ---
 
-@dp.message(F.text == '/start')
+@dp.message(Command('start'))
 async def handle_start(message: types.Message):
     """Приветственное сообщение и инициализация игрока."""
     global TARGET_CHAT_ID
@@ -311,7 +445,7 @@ async def handle_start(message: types.Message):
         # TODO: Сохранить TARGET_CHAT_ID в .env или отдельном хранилище, чтобы он не сбрасывался
 
     # Регистрируем отправителя
-    await update_player_info(message.from_user.id)
+    await update_player_info(message.from_user)
 
     welcome_message = (
         f"🎾 **Бот для настольного тенниса**\n"
@@ -328,57 +462,60 @@ async def handle_start(message: types.Message):
 
 # --- Команда /leaderboard ---
 
-@dp.message(F.text == '/leaderboard')
+@dp.message(Command('leaderboard'))
 async def handle_leaderboard(message: types.Message):
     """Показывает таблицу лидеров."""
-    leaderboard = db.get_leaderboard()
+    leaderboard = await asyncio.to_thread(db.get_leaderboard)
     
     if not leaderboard:
         await message.reply("Рейтинг пока пуст. Зарегистрируйте первый матч!")
         return
 
     # Форматирование
-    response = "🏆 **ТАБЛИЦА ЛИДЕРОВ ELO** 🏆\n\n"
+    parts: List[str] = ["🏆 **ТАБЛИЦА ЛИДЕРОВ ELO** 🏆\n\n"]
     
     for i, (username, rating, wins, losses) in enumerate(leaderboard):
         emoji = {0: "🥇", 1: "🥈", 2: "🥉"}.get(i, "▪️")
-        response += (
+        parts.append(
             f"{emoji} <b>{username}</b> (<code>{rating}</code>)\n"
             f"   В: {wins} | П: {losses}\n"
         )
 
-    await message.reply(response)
+    await message.reply("".join(parts))
 
 
 # --- Команда /stats ---
 
-@dp.message(F.text.startswith('/stats'))
-async def handle_stats(message: types.Message):
+@dp.message(Command('stats'))
+async def handle_stats(message: types.Message, command: CommandObject):
     """Показывает индивидуальную статистику."""
-    parts = message.text.split()
+    parts = command.args.split() if command.args else []
     target_tag = None
     
-    if len(parts) == 2:
-        target_tag = parts[1].lstrip('@')
+    if len(parts) == 1:
+        target_tag = parts[0].lstrip('@')
     
     if not target_tag:
         # Если тег не указан, показываем статистику отправителя
-        await update_player_info(message.from_user.id) # Обновляем на всякий случай
+        await update_player_info(message.from_user) # Обновляем на всякий случай
         user_id = message.from_user.id
     else:
-        user_id = db.get_user_id_by_tag(target_tag)
+        user_id = await asyncio.to_thread(db.get_user_id_by_tag, target_tag)
         
     if user_id is None:
         await message.reply("Пользователь не найден в базе данных. Попросите его отправить /start.")
         return
 
-    stats = db.get_player_stats(user_id)
+    stats = await asyncio.to_thread(db.get_player_stats, user_id)
     
     if not stats:
         await message.reply("Статистика для этого пользователя пока недоступна.")
         return
 
     username, rating, wins, losses = stats
+
+    total = wins + losses
+    winrate = f"{wins / total * 100:.1f}%" if total else "N/A"
     
     response = (
         f"📊 **СТАТИСТИКА ИГРОКА**\n"
@@ -386,34 +523,35 @@ async def handle_stats(message: types.Message):
         f"⚡️ Рейтинг Elo: <code>{rating}</code>\n"
         f"✅ Победы: {wins}\n"
         f"❌ Поражения: {losses}\n"
-        f"📈 Процент побед: {wins / (wins + losses) * 100:.1f}%" if (wins + losses) > 0 else "📈 Процент побед: N/A"
+        f"📈 Процент побед: {winrate}"
     )
     await message.reply(response)
 
 
 # --- Команда /history ---
 
-@dp.message(F.text == '/history')
+@dp.message(Command('history'))
 async def handle_history(message: types.Message):
     """Показывает последние 10 матчей."""
-    history = db.get_match_history(limit=10)
+    history = await asyncio.to_thread(db.get_match_history, limit=10)
 
     if not history:
         await message.reply("История матчей пуста.")
         return
         
-    response = "📜 **ПОСЛЕДНИЕ 10 МАТЧЕЙ** 📜\n\n"
+    parts: List[str] = ["📜 **ПОСЛЕДНИЕ 10 МАТЧЕЙ** 📜\n\n"]
 
-    for match_id, match_type, winner_ids_str, loser_ids_str, score, timestamp in history:
-        winner_ids = [int(i) for i in winner_ids_str.split(',')]
-        loser_ids = [int(i) for i in loser_ids_str.split(',')]
-        
-        winner_names = await resolve_usernames(winner_ids)
-        loser_names = await resolve_usernames(loser_ids)
+    # Разрешаем имена всех участников всех матчей за один вызов
+    all_ids = [uid for _, _, winner_ids, loser_ids, _, _ in history for uid in winner_ids + loser_ids]
+    names = dict(zip(all_ids, await resolve_usernames(all_ids)))
+
+    for match_id, match_type, winner_ids, loser_ids, score, timestamp in history:
+        winner_names = [names[uid] for uid in winner_ids]
+        loser_names = [names[uid] for uid in loser_ids]
         
         date_str = time.strftime("%d.%m.%Y %H:%M", time.localtime(timestamp))
         
-        response += (
+        parts.append(
             f"#{match_id} ({date_str})\n"
             f"   Тип: {match_type}\n"
             f"   Победили: {', '.join(winner_names)}\n"
@@ -421,13 +559,13 @@ async def handle_history(message: types.Message):
             f"   Счет: <b>{score}</b>\n\n"
         )
         
-    await message.reply(response)
+    await message.reply("".join(parts))
 
 
 # --- Административная команда /delete_match (для админа) ---
 
-@dp.message(F.text.startswith('/delete_match'))
-async def handle_delete_match(message: types.Message):
+@dp.message(Command('delete_match'))
+async def handle_delete_match(message: types.Message, command: CommandObject):
     """Удаляет матч по ID из истории (только для админа чата)."""
     
     # 1. Проверка на админа
@@ -441,28 +579,41 @@ async def handle_delete_match(message: types.Message):
         await message.reply("Не удалось проверить права администратора.")
         return
     
-    parts = message.text.split()
-    if len(parts) != 2 or not parts[1].isdigit():
+    parts = command.args.split() if command.args else []
+    if len(parts) != 1 or not parts[0].isdigit():
         await message.reply("Неверный формат. Используйте: <code>/delete_match ID_МАТЧА</code>")
         return
 
-    match_id = int(parts[1])
+    match_id = int(parts[0])
     
-    if db.delete_match_by_id(match_id):
+    if await asyncio.to_thread(db.delete_match_by_id, match_id):
         await message.reply(f"❌ Матч #{match_id} успешно удален из истории.")
     else:
         await message.reply(f"Матч #{match_id} не найден.")
 
 
-# --- Фоновые задачи (APScheduler) ---
+# --- Фоновые задачи ---
+
+async def _cancel_after(match_id: int, chat_id: int, original_message_id: Optional[int], delay: float):
+    """Ждет delay секунд и отменяет заявку, если она все еще не подтверждена."""
+    try:
+        await asyncio.sleep(delay)
+        await delete_pending_match_job(match_id, chat_id, original_message_id)
+    finally:
+        # Удаляем только свою запись: под этим ID мог быть заведен другой таймер
+        if _pending_timers.get(match_id) is asyncio.current_task():
+            del _pending_timers[match_id]
+
+async def delete_pending_match_job(match_id: int, chat_id: int, original_message_id: Optional[int]):
+    """Удаляет заявку, если она не подтверждена через 2 часа."""
+    # Удаление условное: если заявку уже подтвердили или отменили (в т.ч. другой worker с тем же
+    # восстановленным таймером), оповещать не о чем
+    if await asyncio.to_thread(db.delete_pending_match, match_id):
+        # Чат неизвестен (восстановленная после перезапуска заявка) — отменяем без оповещения
+        if not chat_id:
+            logging.info(f"Заявка #{match_id} отменена по тайм-ауту.")
+            return
 
-async def delete_pending_match_job(match_id: int, chat_id: int, original_message_id: int):
-    """Задача планировщика: удаляет заявку, если она не подтверждена через 2 часа."""
-    pending_match_data = db.get_pending_match(match_id)
-    
-    if pending_match_data:
-        db.delete_pending_match(match_id)
-        
         # Оповещение об отмене
         await bot.send_message(
             chat_id, 
@@ -471,18 +622,31 @@ async def delete_pending_match_job(match_id: int, chat_id: int, original_message
         )
         logging.info(f"Заявка #{match_id} отменена по тайм-ауту.")
 
+async def restore_pending_timers():
+    """Восстанавливает таймеры отмены для заявок, сохраненных в БД до перезапуска."""
+    pending = await asyncio.to_thread(db.get_pending_match_timestamps)
+    now = time.time()
+    for match_id, created_at in pending:
+        if match_id in _pending_timers:
+            continue
+        delay = max(0.0, created_at + PENDING_MATCH_TTL - now)
+        # Исходное сообщение после перезапуска неизвестно, оповещаем в TARGET_CHAT_ID без ответа
+        _pending_timers[match_id] = asyncio.create_task(
+            _cancel_after(match_id, TARGET_CHAT_ID, None, delay)
+        )
+    if _pending_timers:
+        logging.info(f"Восстановлено таймеров отмены заявок: {len(_pending_timers)}")
+
 # --- Главная функция запуска Webhook (используется в app.py) ---
 
 async def start_webhook():
-    """Инициализирует планировщик и проверяет настройки базы данных."""
+    """Проверяет настройки базы данных и восстанавливает таймеры заявок."""
     # Убеждаемся, что БД инициализирована
-    db.init_db() 
+    await asyncio.to_thread(db.init_db) 
+
+    # Заявки переживают перезапуск в БД — перезапускаем их таймеры
+    await restore_pending_timers()
 
-    # Запускаем планировщик
-    if not scheduler.running:
-        scheduler.start()
-        logging.info("Планировщик APScheduler запущен.")
-        
     # Диспетчер уже настроен и готов принимать обновления
 
 
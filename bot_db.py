@@ -1,242 +1,429 @@
 import sqlite3
+import threading
 import time
+import atexit
 import json
+from contextlib import contextmanager
 from typing import List, Dict, Any, Tuple
 
 DEFAULT_RATING = 1000
 
+# Максимальный размер кэша username -> ID (при переполнении кэш сбрасывается целиком)
+TAG_CACHE_SIZE = 4096
+# Время жизни записи кэша (секунды): username может смениться через другой worker, чей кэш здесь не виден
+TAG_CACHE_TTL = 60
+
+# Списки ID участников хранятся как JSON-массивы; столбцы с пометкой [json] разбираются автоматически
+sqlite3.register_converter("json", json.loads)
+
+# Схема таблицы игроков (вынесена отдельно: используется и при миграции)
+PLAYERS_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        rating INTEGER NOT NULL DEFAULT %d,
+        wins INTEGER NOT NULL DEFAULT 0,
+        losses INTEGER NOT NULL DEFAULT 0,
+        full_name TEXT
+    )
+""" % DEFAULT_RATING
+
+# Схема таблицы заявок. AUTOINCREMENT: ID удаленных заявок не выдаются повторно, поэтому устаревший
+# таймер отмены (или кнопка подтверждения) не может попасть в новую заявку с тем же ID
+PENDING_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        match_type TEXT NOT NULL,
+        winner_ids TEXT NOT NULL,
+        loser_ids TEXT NOT NULL,
+        score TEXT NOT NULL,
+        timestamp REAL NOT NULL
+    )
+"""
+
+# Изменение рейтинга и статистики игрока (update_player_ratings): ?1 — изменение рейтинга,
+# ?2 — победа (1) или поражение (0), ?3 — ID. Исход передается явно: у победителя изменение может
+# округлиться до 0. Текст фиксированный и остается в кэше запросов
+SQL_APPLY_RATING = (
+    "UPDATE players SET rating = rating + ?1, wins = wins + ?2, losses = losses + (1 - ?2) "
+    "WHERE id = ?3"
+)
+
 class Database:
     """Класс для управления базой данных SQLite."""
     def __init__(self, db_name='bot.db'):
         self.db_name = db_name
+        # Одно долгоживущее соединение на процесс; вызовы приходят из потоков asyncio.to_thread,
+        # поэтому доступ к нему сериализуется блокировкой (RLock: методы вызывают друг друга)
+        self.conn = sqlite3.connect(
+            db_name,
+            detect_types=sqlite3.PARSE_COLNAMES,
+            check_same_thread=False,
+            isolation_level=None,  # autocommit; многошаговые операции — через transaction()
+            # busy timeout: при конкурентной записи (другой worker в BEGIN IMMEDIATE) ждем до 15 секунд
+            timeout=15.0,
+            # Кэш подготовленных запросов живет вместе с соединением; с запасом на IN (...) разной длины
+            cached_statements=256
+        )
+        # row_factory не задаем: строки — обычные кортежи, без накладных расходов sqlite3.Row
+        self._lock = threading.RLock()
+
+        # Кэш username -> (ID, expires_at) и обратный ID -> username: сопоставление меняется только при
+        # смене username. Заполняется при поиске, записи игрока вытесняются в get_or_create_player
+        self._tag_cache: Dict[str, Tuple[int, float]] = {}
+        self._tag_by_id: Dict[int, str] = {}
+
+        # Размер страницы применяется только к новой (пустой) БД и только до перехода в WAL:
+        # у существующего файла в режиме WAL он не меняется даже через VACUUM
+        self.conn.execute("PRAGMA page_size=8192")
+
+        # WAL сохраняется в файле БД; остальные PRAGMA действуют на соединение и задаются один раз.
+        # В режиме WAL достаточно synchronous=NORMAL: fsync только при checkpoint, а не на каждый commit
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        # Чтение страниц через mmap (до 256 МБ) без read()/копирования и кэш страниц 64 МБ
+        self.conn.execute("PRAGMA mmap_size=268435456")
+        self.conn.execute("PRAGMA cache_size=-65536")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+
         self.init_db()
 
-    def get_conn(self):
-        """Возвращает соединение и курсор."""
-        conn = sqlite3.connect(self.db_name)
-        # Устанавливаем row_factory для доступа к столбцам по имени
-        conn.row_factory = sqlite3.Row
-        return conn
+        # Соединение закрывается при завершении процесса (с обновлением статистики планировщика)
+        self._closed = False
+        atexit.register(self.close)
+
+    @contextmanager
+    def transaction(self):
+        """Выполняет блок в одной транзакции (BEGIN IMMEDIATE ... COMMIT/ROLLBACK)."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def close(self):
+        """Закрывает соединение с БД (повторный вызов ничего не делает).
+
+        Перед закрытием выполняется PRAGMA optimize: планировщик обновляет статистику индексов.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self.conn.execute("PRAGMA optimize")
+            self.conn.close()
+            self._closed = True
 
     def init_db(self):
         """Инициализирует таблицы базы данных."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-
-        # Таблица игроков
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS players (
-                id INTEGER PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                rating REAL NOT NULL DEFAULT ?,
-                wins INTEGER NOT NULL DEFAULT 0,
-                losses INTEGER NOT NULL DEFAULT 0,
-                full_name TEXT
-            )
-        """, (DEFAULT_RATING,))
+        with self.transaction() as cursor:
+            # Таблица игроков
+            cursor.execute(PLAYERS_DDL.format(table="players"))
 
-        # Таблица для сопоставления Telegram ID с username
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_mapping (
-                username TEXT PRIMARY KEY,
-                user_id INTEGER NOT NULL
-            )
-        """)
+            # Миграция: рейтинг хранился как REAL — пересоздаем таблицу с INTEGER и округлением
+            cursor.execute("PRAGMA table_info(players)")
+            if any(r[1] == "rating" and r[2].upper() == "REAL" for r in cursor.fetchall()):
+                cursor.execute(PLAYERS_DDL.format(table="players_new"))
+                cursor.execute(
+                    "INSERT INTO players_new (id, username, rating, wins, losses, full_name) "
+                    "SELECT id, username, CAST(ROUND(rating) AS INTEGER), wins, losses, full_name FROM players"
+                )
+                cursor.execute("DROP TABLE players")
+                cursor.execute("ALTER TABLE players_new RENAME TO players")
+
+            # Миграция: username -> ID теперь берется из players.username (UNIQUE), отдельная таблица не нужна
+            cursor.execute("DROP TABLE IF EXISTS user_mapping")
         
-        # Таблица завершенных матчей (история)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS matches (
-                id INTEGER PRIMARY KEY,
-                type TEXT NOT NULL, 
-                winner_ids TEXT NOT NULL, 
-                loser_ids TEXT NOT NULL, 
-                score TEXT NOT NULL,
-                timestamp REAL NOT NULL
-            )
-        """)
-
-        # Таблица ожидающих подтверждения матчей
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS pending_matches (
-                id INTEGER PRIMARY KEY,
-                match_type TEXT NOT NULL,
-                participants TEXT NOT NULL,
-                winner_ids TEXT NOT NULL,
-                loser_ids TEXT NOT NULL,
-                score TEXT NOT NULL,
-                timestamp REAL NOT NULL
-            )
-        """)
-
-        conn.commit()
-        conn.close()
-
-    def update_user_mapping(self, user_id: int, username: str):
-        """Обновляет или добавляет сопоставление username -> ID."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        # ON CONFLICT используется для обновления user_id, если username уже существует
-        cursor.execute(
-            "INSERT INTO user_mapping (username, user_id) VALUES (?, ?) ON CONFLICT(username) DO UPDATE SET user_id=?",
-            (username, user_id, user_id)
-        )
-        conn.commit()
-        conn.close()
+            # Таблица завершенных матчей (история)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS matches (
+                    id INTEGER PRIMARY KEY,
+                    type TEXT NOT NULL, 
+                    score TEXT NOT NULL,
+                    timestamp REAL NOT NULL
+                )
+            """)
+
+            # Участники завершенных матчей (role: 'winner' или 'loser')
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS match_players (
+                    match_id INTEGER NOT NULL REFERENCES matches(id) ON DELETE CASCADE,
+                    user_id INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    PRIMARY KEY (match_id, user_id)
+                )
+            """)
+
+            # Таблица ожидающих подтверждения матчей
+            cursor.execute(PENDING_DDL.format(table="pending_matches"))
+
+            # Миграция: таблица заявок была без AUTOINCREMENT — пересоздаем с сохранением заявок и их ID
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'pending_matches'")
+            if "AUTOINCREMENT" not in cursor.fetchone()[0].upper():
+                cursor.execute(PENDING_DDL.format(table="pending_matches_new"))
+                cursor.execute(
+                    "INSERT INTO pending_matches_new (id, match_type, winner_ids, loser_ids, score, timestamp) "
+                    "SELECT id, match_type, winner_ids, loser_ids, score, timestamp FROM pending_matches"
+                )
+                cursor.execute("DROP TABLE pending_matches")
+                cursor.execute("ALTER TABLE pending_matches_new RENAME TO pending_matches")
+
+            # Миграция: столбец participants больше не используется (участники — winner_ids и loser_ids)
+            cursor.execute("PRAGMA table_info(pending_matches)")
+            if "participants" in {r[1] for r in cursor.fetchall()}:
+                cursor.execute("ALTER TABLE pending_matches DROP COLUMN participants")
+
+            # Индексы для сортировки таблицы лидеров и истории матчей.
+            # idx_leaderboard покрывающий: get_leaderboard читает только индекс, без обращения к строкам
+            cursor.execute("DROP INDEX IF EXISTS idx_players_rating")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_leaderboard ON players(rating DESC, username, wins, losses)")
+            # id — второй ключ сортировки истории: время хранится с точностью до секунды
+            cursor.execute("DROP INDEX IF EXISTS idx_matches_ts")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_matches_recent ON matches(timestamp DESC, id DESC)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_mp_user ON match_players(user_id)")
+
+            # Миграция: старые записи хранили ID через запятую ("1,2") — оборачиваем в JSON-массив
+            for column in ("winner_ids", "loser_ids"):
+                cursor.execute(
+                    f"UPDATE pending_matches SET {column} = '[' || {column} || ']' WHERE {column} NOT LIKE '[%'"
+                )
+
+            # Миграция: участники матчей переезжают из столбцов matches в match_players
+            cursor.execute("PRAGMA table_info(matches)")
+            if "winner_ids" in {r[1] for r in cursor.fetchall()}:
+                for column, role in (("winner_ids", "winner"), ("loser_ids", "loser")):
+                    cursor.execute(
+                        f"UPDATE matches SET {column} = '[' || {column} || ']' WHERE {column} NOT LIKE '[%'"
+                    )
+                    cursor.execute(
+                        f"INSERT OR IGNORE INTO match_players (match_id, user_id, role) "
+                        f"SELECT m.id, j.value, '{role}' FROM matches m, json_each(m.{column}) j"
+                    )
+                    cursor.execute(f"ALTER TABLE matches DROP COLUMN {column}")
+
+    def _remember_tag(self, username: str, user_id: int):
+        """Сохраняет сопоставление username -> ID в кэше."""
+        if len(self._tag_cache) >= TAG_CACHE_SIZE:
+            self._tag_cache.clear()
+            self._tag_by_id.clear()
+        self._tag_cache[username] = (user_id, time.monotonic() + TAG_CACHE_TTL)
+        self._tag_by_id[user_id] = username
+
+    def _cached_tag(self, username: str) -> int | None:
+        """Возвращает ID из кэша, если запись есть и не устарела."""
+        cached = self._tag_cache.get(username)
+        if cached is None:
+            return None
+        user_id, expires_at = cached
+        if expires_at <= time.monotonic():
+            self._forget_tag(user_id, username)
+            return None
+        return user_id
+
+    def _forget_tag(self, user_id: int, username: str):
+        """Убирает из кэша прежний username игрока и прежнего владельца username."""
+        old_username = self._tag_by_id.pop(user_id, None)
+        if old_username is not None:
+            self._tag_cache.pop(old_username, None)
+        cached = self._tag_cache.pop(username, None)
+        if cached is not None:
+            self._tag_by_id.pop(cached[0], None)
 
     def get_user_id_by_tag(self, username: str) -> int | None:
-        """Получает ID по username (тегу)."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM user_mapping WHERE username = ?", (username,))
-        row = cursor.fetchone()
-        conn.close()
-        return row['user_id'] if row else None
+        """Получает ID по username (тегу); найденные ID кэшируются."""
+        with self._lock:
+            user_id = self._cached_tag(username)
+            if user_id is not None:
+                return user_id
+
+            row = self.conn.execute("SELECT id FROM players WHERE username = ?", (username,)).fetchone()
+            if row is None:
+                return None
+            self._remember_tag(username, row[0])
+            return row[0]
+
+    def get_user_ids_by_tags(self, usernames: List[str]) -> Dict[str, int]:
+        """Получает ID нескольких пользователей по username (тегам); в БД запрашиваются только некэшированные."""
+        with self._lock:
+            result = {}
+            for name in usernames:
+                user_id = self._cached_tag(name)
+                if user_id is not None:
+                    result[name] = user_id
+            missing = [name for name in usernames if name not in result]
+            if not missing:
+                return result
+
+            placeholders = ",".join("?" * len(missing))
+            rows = self.conn.execute(
+                f"SELECT username, id FROM players WHERE username IN ({placeholders})",
+                missing
+            ).fetchall()
+            for username, user_id in rows:
+                self._remember_tag(username, user_id)
+                result[username] = user_id
+            return result
 
     def get_or_create_player(self, user_id: int, username: str, full_name: str) -> None:
         """Находит игрока по ID или создает нового."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM players WHERE id = ?", (user_id,))
-        player = cursor.fetchone()
+        with self.transaction() as cursor:
+            # Сопоставление в кэше меняется, только если username сменился
+            if self._tag_by_id.get(user_id) != username:
+                self._forget_tag(user_id, username)
 
-        if player:
-            # Обновляем имя и username игрока, если он уже есть
+            # Username мог перейти от другого игрока: освобождаем его (заглушка — ID, как для игроков без username)
             cursor.execute(
-                "UPDATE players SET username = ?, full_name = ? WHERE id = ?",
-                (username, full_name, user_id)
+                "UPDATE players SET username = CAST(id AS TEXT) WHERE username = ? AND id != ?",
+                (username, user_id)
             )
-        else:
-            # Создаем нового игрока
+
+            # Создаем игрока или обновляем имя и username, если он уже есть
             cursor.execute(
-                "INSERT INTO players (id, username, full_name) VALUES (?, ?, ?)",
+                "INSERT INTO players (id, username, full_name) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET username = excluded.username, full_name = excluded.full_name",
                 (user_id, username, full_name)
             )
-        
-        # Обновляем сопоставление (username -> ID)
-        self.update_user_mapping(user_id, username)
-
-        conn.commit()
-        conn.close()
-
-    def get_player_rating(self, user_id: int) -> int:
-        """Получает рейтинг игрока."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT rating FROM players WHERE id = ?", (user_id,))
-        row = cursor.fetchone()
-        conn.close()
-        # Возвращаем округленный рейтинг
-        return int(round(row['rating'])) if row and row['rating'] is not None else DEFAULT_RATING
-
-    def update_player_rating(self, user_id: int, delta_rating: int):
-        """Обновляет рейтинг и статистику игрока."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        
-        is_winner = delta_rating > 0
-        
-        # Если победа или поражение
-        stat_field = "wins" if is_winner else "losses"
-        
-        cursor.execute(
-            f"UPDATE players SET rating = rating + ?, {stat_field} = {stat_field} + 1 WHERE id = ?",
-            (delta_rating, user_id)
-        )
-        conn.commit()
-        conn.close()
 
-    def add_pending_match(self, match_type: str, participants: List[int], winner_ids: List[int], loser_ids: List[int], score: str) -> int:
-        """Добавляет заявку на подтверждение матча."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
+    def get_players_by_ids(self, user_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        """Получает username и полное имя нескольких игроков одним запросом."""
+        with self._lock:
+            placeholders = ",".join("?" * len(user_ids))
+            rows = self.conn.execute(
+                f"SELECT id, username, full_name FROM players WHERE id IN ({placeholders})",
+                list(user_ids)
+            ).fetchall()
+            return {r[0]: (r[1], r[2]) for r in rows}
 
-        # Преобразуем списки ID в строки для хранения
-        participants_str = ",".join(map(str, participants))
-        winner_ids_str = ",".join(map(str, winner_ids))
-        loser_ids_str = ",".join(map(str, loser_ids))
-        
-        cursor.execute(
-            "INSERT INTO pending_matches (match_type, participants, winner_ids, loser_ids, score, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-            (match_type, participants_str, winner_ids_str, loser_ids_str, score, time.time())
+    def get_player_ratings(self, user_ids: List[int]) -> Dict[int, int]:
+        """Получает рейтинги нескольких игроков одним запросом."""
+        with self._lock:
+            placeholders = ",".join("?" * len(user_ids))
+            ratings = dict(self.conn.execute(
+                f"SELECT id, rating FROM players WHERE id IN ({placeholders})", list(user_ids)
+            ).fetchall())
+            # Для отсутствующих игроков — рейтинг по умолчанию
+            return {uid: ratings.get(uid, DEFAULT_RATING) for uid in user_ids}
+
+    def update_player_ratings(self, changes: List[Tuple[int, int, bool]], cursor: sqlite3.Cursor | None = None):
+        """Обновляет рейтинг и статистику нескольких игроков в одной транзакции.
+
+        :param changes: Список (ID игрока, изменение рейтинга, победа ли это).
+        :param cursor: Курсор внешней транзакции; без него открывается своя.
+        """
+        if cursor is None:
+            with self.transaction() as cursor:
+                self.update_player_ratings(changes, cursor)
+            return
+
+        cursor.executemany(
+            SQL_APPLY_RATING, [(delta, int(is_win), user_id) for user_id, delta, is_win in changes]
         )
-        match_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return match_id
+
+    def add_pending_match(self, match_type: str, winner_ids: List[int], loser_ids: List[int], score: str) -> int:
+        """Добавляет заявку на подтверждение матча."""
+        with self._lock:
+            # Списки ID храним как JSON-массивы
+            cursor = self.conn.execute(
+                "INSERT INTO pending_matches (match_type, winner_ids, loser_ids, score, timestamp) "
+                "VALUES (?, ?, ?, ?, unixepoch())",
+                (match_type, json.dumps(winner_ids), json.dumps(loser_ids), score)
+            )
+            match_id = cursor.lastrowid
+            return match_id
         
-    def get_pending_match(self, match_id: int) -> Tuple[str, str, str, str] | None:
+    def get_pending_match(self, match_id: int) -> Tuple[str, List[int], List[int], str] | None:
         """Получает заявку по ID."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT match_type, winner_ids, loser_ids, score FROM pending_matches WHERE id = ?", (match_id,))
-        row = cursor.fetchone()
-        conn.close()
-        return tuple(row) if row else None
-        
-    def delete_pending_match(self, match_id: int):
-        """Удаляет заявку."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM pending_matches WHERE id = ?", (match_id,))
-        conn.commit()
-        conn.close()
-
-    def finalize_match(self, match_id: int, winner_ids: List[int], loser_ids: List[int], score: str, match_type: str):
-        """Перемещает матч из временной таблицы в историю."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        
-        winner_ids_str = ",".join(map(str, winner_ids))
-        loser_ids_str = ",".join(map(str, loser_ids))
+        with self._lock:
+            return self.conn.execute(
+                'SELECT match_type, winner_ids AS "winner_ids [json]", loser_ids AS "loser_ids [json]", score '
+                'FROM pending_matches WHERE id = ?',
+                (match_id,)
+            ).fetchone()
         
-        cursor.execute(
-            "INSERT INTO matches (type, winner_ids, loser_ids, score, timestamp) VALUES (?, ?, ?, ?, ?)",
-            (match_type, winner_ids_str, loser_ids_str, score, time.time())
-        )
-        
-        # Удаляем из временной таблицы
-        self.delete_pending_match(match_id)
-        
-        conn.commit()
-        conn.close()
-
-    def get_leaderboard(self) -> List[Tuple[str, int, int, int]]:
-        """Получает топ игроков."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT username, rating, wins, losses FROM players ORDER BY rating DESC")
-        rows = cursor.fetchall()
-        conn.close()
-        # Преобразуем рейтинг в int
-        return [(r['username'], int(round(r['rating'])), r['wins'], r['losses']) for r in rows]
+    def get_pending_match_timestamps(self) -> List[Tuple[int, float]]:
+        """Получает ID и время создания всех ожидающих заявок."""
+        with self._lock:
+            return self.conn.execute("SELECT id, timestamp FROM pending_matches").fetchall()
+
+    def delete_pending_match(self, match_id: int, cursor: sqlite3.Cursor | None = None) -> bool:
+        """Удаляет заявку.
+
+        :param cursor: Курсор внешней транзакции; без него запрос выполняется отдельно.
+        :return: True, если заявка была удалена этим вызовом (False — ее уже удалил кто-то другой).
+        """
+        if cursor is not None:
+            return cursor.execute("DELETE FROM pending_matches WHERE id = ?", (match_id,)).rowcount > 0
+        with self._lock:
+            return self.conn.execute("DELETE FROM pending_matches WHERE id = ?", (match_id,)).rowcount > 0
+
+    def finalize_match(self, match_id: int, rating_changes: List[Tuple[int, int, bool]]) -> int | None:
+        """Перемещает матч из временной таблицы в историю и применяет изменения рейтинга (одной транзакцией).
+
+        :param match_id: ID заявки в pending_matches.
+        :param rating_changes: Список (ID игрока, изменение рейтинга, победа ли это).
+        :return: ID матча в истории или None, если заявка уже обработана.
+        """
+        with self.transaction() as cursor:
+            # Тип, счет и участники берутся прямо из заявки, без повторной сериализации в Python
+            cursor.execute(
+                "INSERT INTO matches (type, score, timestamp) "
+                "SELECT match_type, score, unixepoch() FROM pending_matches WHERE id = ?",
+                (match_id,)
+            )
+            if cursor.rowcount == 0:
+                return None
+            new_match_id = cursor.lastrowid
+
+            cursor.execute(
+                "INSERT INTO match_players (match_id, user_id, role) "
+                "SELECT ?, j.value, 'winner' FROM pending_matches p, json_each(p.winner_ids) j WHERE p.id = ? "
+                "UNION ALL "
+                "SELECT ?, j.value, 'loser' FROM pending_matches p, json_each(p.loser_ids) j WHERE p.id = ?",
+                (new_match_id, match_id, new_match_id, match_id)
+            )
+
+            self.update_player_ratings(rating_changes, cursor)
+
+            # Удаляем из временной таблицы
+            self.delete_pending_match(match_id, cursor)
+            return new_match_id
+
+    def get_leaderboard(self, limit: int = 50) -> List[Tuple[str, int, int, int]]:
+        """Получает топ-N игроков (чтение только по индексу idx_leaderboard)."""
+        with self._lock:
+            # Строки — уже готовые кортежи (username, rating, wins, losses), без преобразования в Python
+            return self.conn.execute(
+                "SELECT username, rating, wins, losses FROM players ORDER BY rating DESC LIMIT ?", (limit,)
+            ).fetchall()
 
     def get_player_stats(self, user_id: int) -> Tuple[str, int, int, int] | None:
         """Получает статистику игрока по ID."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT username, rating, wins, losses FROM players WHERE id = ?", (user_id,))
-        row = cursor.fetchone()
-        conn.close()
-        if row:
-            # Округляем рейтинг
-            return row['username'], int(round(row['rating'])), row['wins'], row['losses']
-        return None
+        with self._lock:
+            return self.conn.execute(
+                "SELECT username, rating, wins, losses FROM players WHERE id = ?", (user_id,)
+            ).fetchone()
 
     def get_match_history(self, limit: int = 10) -> List[Tuple]:
         """Получает последние N матчей."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, type, winner_ids, loser_ids, score, timestamp FROM matches ORDER BY timestamp DESC LIMIT ?", (limit,))
-        rows = cursor.fetchall()
-        conn.close()
-        return [(r['id'], r['type'], r['winner_ids'], r['loser_ids'], r['score'], r['timestamp']) for r in rows]
+        with self._lock:
+            # Списки участников собираются из match_players в JSON-массивы
+            return self.conn.execute(
+                "SELECT m.id, m.type, "
+                "(SELECT json_group_array(user_id) FROM match_players WHERE match_id = m.id AND role = 'winner') "
+                'AS "winner_ids [json]", '
+                "(SELECT json_group_array(user_id) FROM match_players WHERE match_id = m.id AND role = 'loser') "
+                'AS "loser_ids [json]", '
+                "m.score, m.timestamp "
+                "FROM matches m ORDER BY m.timestamp DESC, m.id DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
 
     def delete_match_by_id(self, match_id: int) -> bool:
-        """Удаляет матч из истории."""
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM matches WHERE id = ?", (match_id,))
-        deleted_rows = cursor.rowcount
-        conn.commit()
-        conn.close()
-        return deleted_rows > 0
+        """Удаляет матч из истории (участники удаляются каскадно)."""
+        with self._lock:
+            deleted_rows = self.conn.execute("DELETE FROM matches WHERE id = ?", (match_id,)).rowcount
+            return deleted_rows > 0